@@ -1,24 +1,75 @@
 # /// script
 # requires-python = ">=3.12"
 # dependencies = [
+#     "orjson",
 #     "pyyaml",
 #     "requests",
+#     "requests-cache",
 #     "tqdm"
 # ]
 # ///
 
 import os
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import chain, repeat
 from typing import Dict, List, Optional
-from yaml import load, dump, Loader
+from yaml import load, dump
+import orjson
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util import Retry
+
+try:
+    from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as Loader, SafeDumper as Dumper
 
 with open("dashboard.yml") as f:
     config = load(f, Loader=Loader)
 
-session = requests.Session()
+# GitHub disables scheduled workflows after this many days without activity.
+INACTIVITY_DAYS = 60
+
+
+def load_prior_packages() -> Dict[str, dict]:
+    """
+    Index the packages of the previous snapshot, if any, by repository.
+    """
+    try:
+        with open("generated.yml") as f:
+            prior = load(f, Loader=Loader) or {}
+    except FileNotFoundError:
+        return {}
+    return {
+        package["repo"]: package
+        for section in prior.get("sections") or []
+        for package in section.get("packages") or []
+    }
+
+
+prior_packages = load_prior_packages()
+
+# Requests are almost entirely network-bound, so run well more workers than
+# cores; the HTTP pool below is sized to match.
+MAX_WORKERS = int(os.getenv("GH_CONCURRENCY", "16"))
+
+# Cap concurrent GraphQL queries to stay under GitHub's secondary rate limits.
+graphql_semaphore = threading.BoundedSemaphore(10)
+
+# REST responses are kept in a local SQLite cache and revalidated with their
+# ETag, so unchanged resources come back as bodiless 304s. GitHub's GraphQL
+# endpoint does not support conditional requests, and POSTs are not cached.
+session = requests_cache.CachedSession(
+    "gh_cache",
+    backend="sqlite",
+    expire_after=300,
+    cache_control=True,
+)
 session.headers.update(
     {
         "Accept": "application/vnd.github+json",
@@ -31,51 +82,139 @@ token = os.getenv("GITHUB_TOKEN")
 if token:
     session.headers["Authorization"] = f"Bearer {token}"
 
-
-def build_session() -> requests.Session:
-    new_session = requests.Session()
-    new_session.headers.update(session.headers)
-    return new_session
+# One pooled session is shared by all worker threads so that keep-alive
+# connections to api.github.com are reused across packages.
+adapter = HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS,
+    # Transient failures are retried with exponential backoff. The GraphQL
+    # queries are read-only, so POST is safe to retry as well.
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
 
 
+@lru_cache(maxsize=4096)
 def format_date(iso_timestamp: str) -> str:
-    return (
-        datetime.fromisoformat(iso_timestamp.replace("Z", "+00:00")).date().isoformat()
-    )
+    return datetime.fromisoformat(iso_timestamp).date().isoformat()
 
 
-STATUS_ROLLUP_QUERY = """
-query($owner:String!,$name:String!){
-  repository(owner:$owner,name:$name){
-    defaultBranchRef{
-      target{
-        ... on Commit{
-          oid
-          commitUrl
-          committedDate
-          author{ user{login} name }
-          statusCheckRollup{ state }
-        }
+# Number of repositories looked up per GraphQL request.
+BATCH_SIZE = 20
+
+REPOSITORY_FRAGMENTS = """
+fragment Meta on Repository{
+  createdAt
+  updatedAt
+  description
+  diskUsage
+  stargazerCount
+  issues(states:OPEN){ totalCount }
+  pullRequests(states:OPEN){ totalCount }
+  repositoryTopics(first:20){ nodes{ topic{name} } }
+}
+fragment Commit on Repository{
+  defaultBranchRef{
+    target{
+      ... on Commit{
+        oid
+        commitUrl
+        committedDate
+        author{ user{login} name }
+        statusCheckRollup{ state }
       }
     }
   }
 }
+fragment Release on Repository{
+  releases(first:1, orderBy:{field:CREATED_AT, direction:DESC}){
+    nodes{ url tagName publishedAt createdAt }
+  }
+}
+fragment Workflows on Repository{
+  workflowsTree: object(expression:"HEAD:.github/workflows"){
+    ... on Tree{ entries{ name } }
+  }
+}
 """
 
 
-def fetch_last_commit_info(
-    owner: str, repo: str, session: requests.Session
-) -> Optional[dict]:
+@lru_cache(maxsize=None)
+def batch_payload_prefix(size: int) -> bytes:
     """
-    Fetch latest default-branch commit and its merged checks/status rollup via GraphQL.
+    Encode the GraphQL request body for a batch of ``size`` repositories, up to
+    (but not including) the variables object. Owners and names are passed as
+    variables, so the query only depends on the batch size and is built once.
     """
-    resp = session.post(
-        "https://api.github.com/graphql",
-        json={"query": STATUS_ROLLUP_QUERY, "variables": {"owner": owner, "name": repo}},
+    params = ",".join(f"$o{index}:String!,$n{index}:String!" for index in range(size))
+    lookups = "\n".join(
+        f"  r{index}: repository(owner:$o{index},name:$n{index})"
+        "{ ...Meta ...Commit ...Release ...Workflows }"
+        for index in range(size)
     )
-    if not resp.ok:
-        return None
-    repo_data = (resp.json().get("data") or {}).get("repository") or {}
+    query = f"query({params}){{\n{lookups}\n}}\n{REPOSITORY_FRAGMENTS}"
+    return b'{"query":' + orjson.dumps(query) + b',"variables":'
+
+
+def fetch_batch_info(packages: List[dict], session: requests.Session) -> List[dict]:
+    """
+    Fetch metadata, latest commit and latest release for several repositories
+    with one GraphQL request. Results are returned in the order of ``packages``;
+    repositories that do not exist are returned as empty dicts, and any other
+    GraphQL error is raised.
+    """
+    variables = {}
+    for index, package in enumerate(packages):
+        variables[f"o{index}"] = package["user"]
+        variables[f"n{index}"] = package["name"]
+    payload = batch_payload_prefix(len(packages)) + orjson.dumps(variables) + b"}"
+    with graphql_semaphore:
+        resp = session.post(
+            "https://api.github.com/graphql",
+            data=payload,
+            headers={"Content-Type": "application/json"},
+        )
+    resp.raise_for_status()
+    body = orjson.loads(resp.content)
+    data = body.get("data")
+    errors = body.get("errors") or []
+    # Rate limiting and timeouts can come back as a 200 with top-level errors;
+    # only a missing repository (NOT_FOUND on its alias) is tolerated.
+    if data is None or any(error.get("type") != "NOT_FOUND" for error in errors):
+        raise RuntimeError(f"GraphQL batch query failed: {errors}")
+    return [data.get(f"r{index}") or {} for index in range(len(packages))]
+
+
+def parse_repo_info(repo_data: dict) -> dict:
+    """
+    Extract repository metadata from a GraphQL repository result.
+    """
+    topics = (repo_data.get("repositoryTopics") or {}).get("nodes") or []
+    return {
+        "created_at": repo_data.get("createdAt"),
+        "updated_at": repo_data.get("updatedAt"),
+        # Match the REST ``open_issues_count``, which includes pull requests.
+        "open_issues": (repo_data.get("issues") or {}).get("totalCount", 0)
+        + (repo_data.get("pullRequests") or {}).get("totalCount", 0),
+        "stargazers_count": repo_data.get("stargazerCount"),
+        "description": repo_data.get("description"),
+        "topics": [node["topic"]["name"] for node in topics],
+        "size": repo_data.get("diskUsage"),
+    }
+
+
+def parse_last_commit_info(repo_data: dict) -> Optional[dict]:
+    """
+    Extract the latest default-branch commit and its merged checks/status rollup.
+    """
     branch_ref = repo_data.get("defaultBranchRef") or {}
     commit = branch_ref.get("target") or {}
     if not commit:
@@ -93,46 +232,19 @@ def fetch_last_commit_info(
     }
 
 
-def fetch_repo_info(owner: str, repo: str, session: requests.Session) -> Optional[dict]:
-    """
-    Fetch repository metadata from the GitHub API.
-    """
-    resp = session.get(f"https://api.github.com/repos/{owner}/{repo}")
-    if resp.status_code == 404:
-        return
-    info = resp.json()
-    return {
-        "created_at": info.get("created_at"),
-        "updated_at": info.get("updated_at"),
-        "open_issues": info.get("open_issues_count"),
-        "stargazers_count": info.get("stargazers_count"),
-        "description": info.get("description"),
-        "topics": info.get("topics", []),
-        "size": info.get("size"),
-    }
-
-
-def fetch_last_release_info(
-    owner: str, repo: str, session: requests.Session
-) -> Optional[dict]:
+def parse_last_release_info(repo_data: dict) -> Optional[dict]:
     """
-    Fetch latest release from the GitHub API.
+    Extract the latest release from a GraphQL repository result.
     """
-    releases_resp = session.get(
-        f"https://api.github.com/repos/{owner}/{repo}/releases", params={"per_page": 1}
-    )
-    if releases_resp.status_code == 404:
-        return None
-
-    releases = releases_resp.json()
+    releases = (repo_data.get("releases") or {}).get("nodes") or []
     if not releases:
         return None
 
     last_release = releases[0]
-    published_at = last_release.get("published_at") or last_release.get("created_at")
+    published_at = last_release.get("publishedAt") or last_release.get("createdAt")
     return {
-        "url": last_release.get("html_url"),
-        "tag_name": last_release.get("tag_name"),
+        "url": last_release.get("url"),
+        "tag_name": last_release.get("tagName"),
         "date": format_date(published_at) if published_at else None,
     }
 
@@ -143,18 +255,16 @@ def fetch_disabled_inactive_workflows(
     """
     Return names/paths for workflows auto-disabled due to inactivity.
     """
-    page = 1
     disabled: List[str] = []
-    while True:
-        resp = session.get(
-            f"https://api.github.com/repos/{owner}/{repo}/actions/workflows",
-            params={"per_page": 100, "page": page},
-        )
-        if resp.status_code in (403, 404):
-            break
-        if not resp.ok:
+    url: Optional[str] = (
+        f"https://api.github.com/repos/{owner}/{repo}/actions/workflows?per_page=100"
+    )
+    while url:
+        resp = session.get(url)
+        if resp.status_code in (404, 410):
             break
-        data = resp.json() or {}
+        resp.raise_for_status()
+        data = orjson.loads(resp.content) or {}
         workflows = data.get("workflows") or []
         for workflow in workflows:
             if (workflow.get("state") or "").lower() == "disabled_inactivity":
@@ -163,58 +273,109 @@ def fetch_disabled_inactive_workflows(
                 )
                 if label:
                     disabled.append(label)
-        if len(workflows) < 100:
+        if not workflows:
             break
-        page += 1
+        # Follow the server-provided next page rather than guessing from the
+        # page length, which costs an extra request on exact multiples of 100.
+        url = resp.links.get("next", {}).get("url")
     return disabled
 
 
-def process_package(package: dict) -> None:
+def workflows_unchanged(prior: Optional[dict]) -> bool:
     """
-    Populate metadata for a single package. Runs in worker threads.
+    Whether the previous snapshot proves no workflow can have been disabled for
+    inactivity since: none were disabled then, and the last commit it recorded
+    is recent enough that the inactivity window cannot have elapsed yet.
     """
-    local_session = build_session()
-    package["user"], package["name"] = package["repo"].split("/")
+    if not prior or prior.get("disabled_workflows"):
+        return False
+    last_commit_date = (prior.get("last_commit") or {}).get("date")
+    if not last_commit_date:
+        return False
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=INACTIVITY_DAYS - 1)
+    return date.fromisoformat(str(last_commit_date)) > cutoff
+
 
-    repo_info = fetch_repo_info(package["user"], package["name"], local_session)
-    if repo_info:
-        package["repo_info"] = repo_info
-    else:
+def process_package(package: dict, repo_data: dict) -> bool:
+    """
+    Populate metadata for a single package from its batched GraphQL result.
+    Returns whether the repository's workflows need to be looked up.
+    """
+    if not repo_data:
         package["error"] = True
+        return False
 
-    last_commit_info = fetch_last_commit_info(
-        package["user"], package["name"], local_session
-    )
+    package["repo_info"] = parse_repo_info(repo_data)
+
+    last_commit_info = parse_last_commit_info(repo_data)
     if last_commit_info:
         package["last_commit"] = last_commit_info
 
-    last_release_info = fetch_last_release_info(
-        package["user"], package["name"], local_session
-    )
+    last_release_info = parse_last_release_info(repo_data)
     if last_release_info:
         package["last_release"] = last_release_info
 
+    if not (repo_data.get("workflowsTree") or {}).get("entries"):
+        return False
+    return not workflows_unchanged(prior_packages.get(package["repo"]))
+
+
+def process_batch(packages: List[dict], session: requests.Session) -> List[dict]:
+    """
+    Populate GraphQL metadata for a batch of packages. Runs in worker threads.
+    Returns the packages whose workflows still need to be looked up.
+    """
+    return [
+        package
+        for package, repo_data in zip(packages, fetch_batch_info(packages, session))
+        if process_package(package, repo_data)
+    ]
+
+
+def process_workflows(package: dict, session: requests.Session) -> None:
+    """
+    Record workflows disabled for inactivity for a package. Runs in worker threads.
+    """
     disabled_workflows = fetch_disabled_inactive_workflows(
-        package["user"], package["name"], local_session
+        package["user"], package["name"], session
     )
     if disabled_workflows:
         package["disabled_workflows"] = disabled_workflows
 
 
-all_packages: List[dict] = []
-for section in config:
-    all_packages.extend(section["packages"])
+all_packages: List[dict] = list(
+    chain.from_iterable(section["packages"] for section in config)
+)
+
+for package in all_packages:
+    package["user"], package["name"] = package["repo"].split("/", 1)
 
-with ThreadPoolExecutor(max_workers=4) as executor:
-    futures = [executor.submit(process_package, package) for package in all_packages]
-    for future in tqdm(as_completed(futures), total=len(futures)):
+batches = [
+    all_packages[start : start + BATCH_SIZE]
+    for start in range(0, len(all_packages), BATCH_SIZE)
+]
+
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    # Repositories without workflow files are skipped; the rest are queued in
+    # batch order as map() yields each result, overlapping with later batches.
+    # map() re-raises any worker exception when its result is reached.
+    workflow_futures = []
+    batch_results = executor.map(process_batch, batches, repeat(session))
+    for pending in tqdm(batch_results, total=len(batches)):
+        workflow_futures.extend(
+            executor.submit(process_workflows, package, session) for package in pending
+        )
+    for future in tqdm(as_completed(workflow_futures), total=len(workflow_futures)):
         # re-raise any worker exceptions
         future.result()
 
 snapshot = {
-    "generated_at": datetime.utcnow().isoformat() + "Z",
+    "generated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
     "sections": config,
 }
 
-with open("generated.yml", "w") as generated_output:
-    dump(snapshot, generated_output)
+# Render in memory and swap the file into place, so the page never sees a
+# partially written snapshot.
+with open("generated.yml.tmp", "wb") as generated_output:
+    generated_output.write(dump(snapshot, Dumper=Dumper, encoding="utf-8"))
+os.replace("generated.yml.tmp", "generated.yml")